@@ -4,46 +4,97 @@ import tensorflow as tf
 from tensorflow.keras import layers
 import matplotlib.pyplot as plt
 import numpy as np
+import queue
+import threading
 from datetime import datetime
 
 RESIZE_FACTOR = 2
+NUM_ENVS = 8
+
+# hidden layers compute in bf16, variables and adam state stay fp32, no loss scaling needed for bf16
+tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
 
 class ReplayMemoryBuffer:
-    def __init__(self, size, observation_shape, action_space_dim):
+    def __init__(self, size, observation_shape, action_space_dim, num_envs=1, observation_dtype=np.float32):
         self.counter = 0
         self.pointer = 0
         self.max_size = size
+        # each store writes one row per env, so the next state of row i is row (i + num_envs) % size
+        self.num_envs = num_envs
+
+        # storage lives in tf.Variables on the default device (gpu if there is one) so a batch is a
+        # device side gather instead of a numpy gather + host to device copy of the whole batch
+        # uint8 image observations are kept raw (4x smaller) and only turned into floats after the gather,
+        # any other dtype (including non image integer obs that would wrap in uint8) is stored as float32
+        self.image_frames = np.dtype(observation_dtype) == np.uint8
+        frames_dtype = tf.uint8 if self.image_frames else tf.float32
+        self.frames = tf.Variable(tf.zeros((size, *observation_shape), dtype=frames_dtype), trainable=False)
+        self.actions = tf.Variable(tf.zeros((size, action_space_dim), dtype=tf.float32), trainable=False)
+        # [size, 1] and 0/1 floats so a sampled batch already has the shape and dtype the update uses
+        self.rewards = tf.Variable(tf.zeros((size, 1), dtype=tf.float32), trainable=False)
+        self.terminal = tf.Variable(tf.zeros((size, 1), dtype=tf.float32), trainable=False)
+        # host side flag per row, a time limit truncated row is not terminal but its next row is already
+        # the auto reset observation of the next episode, so it must never be sampled
+        self.valid = np.zeros(size, dtype=np.bool_)
+
+        # the env loop writes while the learner thread samples, once the buffer wraps every row can be
+        # sampled so a write and a gather of the same rows must not interleave (torn rows)
+        self.lock = threading.Lock()
+
+    def store(self, frames, actions, rewards, terminals, truncated):
+        # any number of rows in step major order (every env for step t, then t+1, ...) so the
+        # num_envs stride still holds, written as one slice host -> device per array
+        n = len(frames)
+        frames = np.asarray(frames, dtype=self.frames.dtype.as_numpy_dtype)
+        actions = np.asarray(actions, dtype=np.float32)
+        rewards = np.asarray(rewards, dtype=np.float32)[:, None]
+        valid = np.asarray(terminals, dtype=np.bool_) | ~np.asarray(truncated, dtype=np.bool_)
+        terminals = np.asarray(terminals, dtype=np.float32)[:, None]
+
+        with self.lock:
+            indexes = ((self.pointer + np.arange(n)) % self.max_size)[:, None]
+            self.frames.scatter_nd_update(indexes, frames)
+            self.actions.scatter_nd_update(indexes, actions)
+            self.rewards.scatter_nd_update(indexes, rewards)
+            self.terminal.scatter_nd_update(indexes, terminals)
+            self.valid[indexes[:, 0]] = valid
+
+            self.counter = min(self.max_size, max(self.counter, self.pointer + n))
+            self.pointer = (self.pointer + n) % self.max_size
+
+    def sample_batch(self, batch_size, block_size=8):
+        # a few random offsets with short contiguous runs after each one, reads whole cache lines
+        # instead of one scattered row per sample and is close enough to iid for a big buffer
+        # indexes and gathers come from one consistent snapshot of pointer / counter / rows
+        with self.lock:
+            # offsets are logical, counted from the oldest row (row 0 before the buffer wraps, pointer after),
+            # the newest num_envs rows are left out since their next state has not been written yet
+            oldest = (self.pointer - self.counter) % self.max_size
+            high = self.counter - self.num_envs
+            num_blocks = -(-batch_size // block_size)
+            offsets = np.random.randint(low=0, high=high, size=num_blocks)
+            logical = ((offsets[:, None] + np.arange(block_size)) % high).ravel()[:batch_size]
+            # redraw the few truncated rows (one per episode) so the batch size stays fixed
+            invalid = ~self.valid[(oldest + logical) % self.max_size]
+            while invalid.any():
+                logical[invalid] = np.random.randint(low=0, high=high, size=invalid.sum())
+                invalid = ~self.valid[(oldest + logical) % self.max_size]
+            indexes = (oldest + logical) % self.max_size
+            next_indexes = tf.convert_to_tensor((indexes + self.num_envs) % self.max_size)
+            indexes = tf.convert_to_tensor(indexes)
+            batch = dict(
+                s   = tf.gather(self.frames, indexes),
+                a   = tf.gather(self.actions, indexes),
+                # i will not shift r since we start with r_t+1 anyways so gotta assume offset -1 :(
+                r   = tf.gather(self.rewards, indexes),
+                s2  = tf.gather(self.frames, next_indexes),
+                d   = tf.gather(self.terminal, indexes)
+            )
+
+        if self.image_frames:
+            batch['s'] = tf.cast(batch['s'], tf.float32) / 255.0
+            batch['s2'] = tf.cast(batch['s2'], tf.float32) / 255.0
 
-        self.frames = np.empty((size, *observation_shape), dtype=np.float32)
-        self.actions = np.empty((size, action_space_dim), dtype=np.float32)
-        self.rewards = np.empty(size, dtype=np.float32)
-        self.terminal = np.empty(size, dtype=np.bool_)
-
-    def store(self, frame, action, reward, terminal):
-        self.frames[self.pointer] = frame
-        self.actions[self.pointer] = action
-        self.rewards[self.pointer] = reward
-        self.terminal[self.pointer] = terminal
-
-        self.counter = max(self.counter, self.pointer + 1)
-        self.pointer = (self.pointer + 1) % self.max_size
-
-    def sample_batch(self, batch_size):
-        indexes = np.random.randint(low=0, high=self.counter - 1, size=batch_size)
-        batch = dict(
-            s   = self.frames[indexes],
-            a   = self.actions[indexes],
-            # i will not shift r since we start with r_t+1 anyways so gotta assume offset -1 :(
-            r   = self.rewards[indexes],
-            s2  = self.frames[indexes + 1],
-            d   = self.terminal[indexes]
-        )
-        batch['s']  = tf.convert_to_tensor(batch['s'], dtype=tf.float32)
-        batch['a'] = tf.convert_to_tensor(batch['a'], dtype=tf.float32)
-        batch['r']  = tf.convert_to_tensor(batch['r'], dtype=tf.float32)
-        batch['s2']  = tf.convert_to_tensor(batch['s2'], dtype=tf.float32)
-        batch['d']  = tf.convert_to_tensor(batch['d'], dtype=tf.float32)
-        
         return batch
 
 
@@ -65,7 +116,8 @@ class QValue(tf.keras.Model):
                 layers.Dense(size, activation='relu')
             )
         
-        self.final_q = layers.Dense(1, activation=None)
+        # fp32 output so the losses are computed in full precision
+        self.final_q = layers.Dense(1, activation=None, dtype='float32')
     
     def call(self, state, action):
         # i dont know how they want me to use the action so im just going to concat after conv 
@@ -76,7 +128,7 @@ class QValue(tf.keras.Model):
 
         x = self.flatten(x)
 
-        x = tf.concat([x,action], axis=-1)
+        x = tf.concat([x, tf.cast(action, x.dtype)], axis=-1)
 
         for fc in self.fc_layers:
             x = fc(x)
@@ -107,10 +159,11 @@ class PolicyPi(tf.keras.Model):
                 layers.Dense(size, activation='relu')
             )
         
-        self.mu = layers.Dense(action_space_dim, activation=None)
+        # fp32 outputs so the gaussian / squash log math is computed in full precision
+        self.mu = layers.Dense(action_space_dim, activation=None, dtype='float32')
 
         # will later be expontinated to get the regular std value to ensure +ve
-        self.log_std = layers.Dense(action_space_dim, activation=None)
+        self.log_std = layers.Dense(action_space_dim, activation=None, dtype='float32')
 
     def call(self, state):
         x = state
@@ -129,47 +182,56 @@ class PolicyPi(tf.keras.Model):
 
         std = tf.exp(log_std)
         
-        return mu, std
+        return mu, std, log_std
 
-    def sample_action(self, state):
-        mu, std = self(state)
+    @tf.function(jit_compile=True)
+    def sample_action(self, state, seed):
+        mu, std, log_std = self(state)
 
         # reparameterization trick with squished gaussian (tanh) to sample action
-        xi = tf.random.normal(tf.shape(mu))
+        # stateless so xla can fuse it with the gaussian math, caller passes a fresh [2] seed every call
+        xi = tf.random.stateless_normal(tf.shape(mu), seed=seed)
         a_bar = mu + std * xi
         action = tf.tanh(a_bar)
 
-        # log likelihood of standard gaussian and dealing case divide by 0
+        # log likelihood of gaussian
         # https://www.statlect.com/fundamentals-of-statistics/normal-distribution-maximum-likelihood 
-        # dropped constnats since will be part of lr anyways
-        log_gaussian = -0.5 * ( ( (a_bar - mu)/(std+1e-6) )**2 + 2*tf.math.log(std+1e-6) + np.log(2*np.pi)  )
-
-        log_gaussian = tf.reduce_sum(log_gaussian, axis=1, keepdims=True)
+        # (a_bar - mu) / std is just xi and log(std) is log_std, so no divide by std needed
+        log_gaussian = tf.reduce_sum( -0.5 * (xi * xi + 2*log_std + np.log(2*np.pi)), axis=1, keepdims=True )
 
         # seemse like correction is required after reparameterization
         # https://github.com/haarnoja/sac/blob/master/sac/policies/gaussian_policy.py#L74
-        log_squash = tf.reduce_sum( tf.math.log(1 - action**2 + 1e-6), axis=1, keepdims=True )
+        # log(1 - tanh(x)^2) = 2 * (log(2) - x - softplus(-2x)), stable near |action| = 1 without the eps
+        log_squash = tf.reduce_sum( 2.0 * (np.log(2.0) - a_bar - tf.nn.softplus(-2.0 * a_bar)), axis=1, keepdims=True )
 
         log_prob = log_gaussian - log_squash
 
         return action, log_prob
     
 
+@tf.function
+def _sync(target, source):
+    # hard copy of source weights into target on device, get/set_weights goes through numpy
+    for target_weight, weight in zip(target.variables, source.variables):
+        target_weight.assign(weight)
+
+
 class SAC:
-    def __init__(self, observation_shape, action_space_dim, gamma=0.99, polyak=0.995, alpha=0.2, Q_lr=3e-4, pi_lr=3e-4):
+    def __init__(self, observation_shape, action_space_dim, gamma=0.99, polyak=0.995, alpha=0.2, Q_lr=3e-4, pi_lr=3e-4, batch_size=256, num_envs=1, observation_dtype=np.float32):
         # observation_shape_new = []
         # observation_shape_new.append(observation_shape[0] // RESIZE_FACTOR)
         # observation_shape_new.append(observation_shape[1] // RESIZE_FACTOR)
         # observation_shape_new.append(observation_shape[2])
         # print(observation_shape_new.shape)
 
-        self.replayMemoryBuffer = ReplayMemoryBuffer(1000000, observation_shape, action_space_dim)
+        self.replayMemoryBuffer = ReplayMemoryBuffer(1000000, observation_shape, action_space_dim, num_envs, observation_dtype)
         
         self.gamma = gamma
         self.polyak = polyak
         self.alpha = alpha
         self.Q_lr = Q_lr
         self.pi_lr = pi_lr
+        self.batch_size = batch_size
 
         # we need four Q in total - two for phi and two for phi target
         # self.Q1 = QValue(conv_sizes=[[32,8,4], [64,4,3], [64,3,1]], dense_sizes=[256])
@@ -184,42 +246,90 @@ class SAC:
         self.Q2_target = QValue(conv_sizes=[], dense_sizes=[256, 256])
         self.pi = PolicyPi(conv_sizes=[], dense_sizes=[256, 256], action_space_dim=action_space_dim)
 
-
-        self.Q1_target.set_weights(self.Q1.get_weights())
-        self.Q2_target.set_weights(self.Q2.get_weights())
-
-        self.Q1_optim = tf.keras.optimizers.Adam(self.Q_lr)
-        self.Q2_optim = tf.keras.optimizers.Adam(self.Q_lr)
+        # dummy forward pass so every model has its variables before we copy / cache them
+        dummy_state = tf.zeros((1, *observation_shape), dtype=tf.float32)
+        dummy_action = tf.zeros((1, action_space_dim), dtype=tf.float32)
+        for Q in (self.Q1, self.Q2, self.Q1_target, self.Q2_target):
+            Q(dummy_state, dummy_action)
+        self.pi(dummy_state)
+
+        _sync(self.Q1_target, self.Q1)
+        _sync(self.Q2_target, self.Q2)
+
+        # stateless rng counters for sample_action, one per thread (acting / learner) so they never race on the
+        # same counter, the second seed element keeps the streams apart, random start so runs dont share noise
+        rng_start = np.random.randint(0, 2**31 - 1)
+        self._act_rng_step = tf.Variable(rng_start, dtype=tf.int64, trainable=False)
+        self._update_rng_step = tf.Variable(rng_start, dtype=tf.int64, trainable=False)
+
+        # keras rebuilds these lists on every access so grab them once
+        self._q_vars = self.Q1.trainable_variables + self.Q2.trainable_variables
+        self._pi_vars = self.pi.trainable_variables
+        self._target_q_vars = self.Q1_target.trainable_variables + self.Q2_target.trainable_variables
+
+        # adam is per parameter so one optimizer over Q1 + Q2 is the same as two separate ones
+        self.Q_optim = tf.keras.optimizers.Adam(self.Q_lr)
         self.pi_optim = tf.keras.optimizers.Adam(self.pi_lr)
-
-    @tf.function
-    def update(self, batch_size=256):
-        batch = self.replayMemoryBuffer.sample_batch(batch_size)
-        s, a, r, s2, d = batch['s'], batch['a'], batch['r'], batch['s2'], batch['d']
-
-        with tf.GradientTape(persistent=True) as tape:
-            a2, lpi2 = self.pi.sample_action(s2)
-            q_1_target_v = self.Q1_target(s2, a2)
-            q_2_target_v = self.Q2_target(s2, a2)
-            
-            compare_q_target = tf.minimum(q_1_target_v, q_2_target_v)
-
-            y = r[:, None] + self.gamma * (1 - d[:, None]) * (compare_q_target - self.alpha * lpi2)
-
+        self.Q_optim.build(self._q_vars)
+        self.pi_optim.build(self._pi_vars)
+
+        # fixed shapes so the update step is traced exactly once, XLA fuses the small mlp kernels
+        self._update_step = tf.function(self._update_step, jit_compile=True, input_signature=[
+            tf.TensorSpec([batch_size, *observation_shape], tf.float32),
+            tf.TensorSpec([batch_size, action_space_dim], tf.float32),
+            tf.TensorSpec([batch_size, 1], tf.float32),
+            tf.TensorSpec([batch_size, *observation_shape], tf.float32),
+            tf.TensorSpec([batch_size, 1], tf.float32),
+        ])
+
+        # one observation per env from the env loop, only the action is needed there
+        self.select_action = tf.function(self.select_action, jit_compile=True, input_signature=[
+            tf.TensorSpec([num_envs, *observation_shape], tf.float32),
+        ])
+
+    def select_action(self, observation):
+        # same scaling the buffer applies to sampled image frames
+        if self.replayMemoryBuffer.image_frames:
+            observation = observation / 255.0
+        step = self._act_rng_step.read_value()
+        self._act_rng_step.assign_add(1)
+        action, _ = self.pi.sample_action(observation, tf.stack([step, 0]))
+        return action
+
+    def update(self):
+        # index sampling stays in python (numpy rng), only the math goes into the graph
+        batch = self.replayMemoryBuffer.sample_batch(self.batch_size)
+        return self._update_step(batch['s'], batch['a'], batch['r'], batch['s2'], batch['d'])
+
+    def _update_step(self, s, a, r, s2, d):
+        step = self._update_rng_step.read_value()
+        self._update_rng_step.assign_add(1)
+
+        # target is a constant for the Q loss so keep it off the tape
+        a2, lpi2 = self.pi.sample_action(s2, tf.stack([step, 1]))
+        q_1_target_v = self.Q1_target(s2, a2)
+        q_2_target_v = self.Q2_target(s2, a2)
+
+        compare_q_target = tf.minimum(q_1_target_v, q_2_target_v)
+
+        y = r + self.gamma * (1 - d) * (compare_q_target - self.alpha * lpi2)
+        y = tf.stop_gradient(y)
+
+        with tf.GradientTape() as tape:
             q_1_v = self.Q1(s, a)
             q_2_v = self.Q2(s, a)
 
             q_1_loss = tf.reduce_sum((q_1_v - y) ** 2)
             q_2_loss = tf.reduce_sum((q_2_v - y) ** 2)
+            # Q1 and Q2 dont share weights so one backward pass over the sum gives both grads
+            q_loss = q_1_loss + q_2_loss
 
-        q_1_grad = tape.gradient(q_1_loss, self.Q1.trainable_variables)
-        q_2_grad = tape.gradient(q_2_loss, self.Q2.trainable_variables)
-        self.Q1_optim.apply_gradients(zip(q_1_grad, self.Q1.trainable_variables))
-        self.Q2_optim.apply_gradients(zip(q_2_grad, self.Q2.trainable_variables))
+        q_grad = tape.gradient(q_loss, self._q_vars)
+        self.Q_optim.apply_gradients(zip(q_grad, self._q_vars))
 
 
-        with tf.GradientTape(persistent=True) as tape:
-            a1, lpi1 = self.pi.sample_action(s)
+        with tf.GradientTape() as tape:
+            a1, lpi1 = self.pi.sample_action(s, tf.stack([step, 2]))
 
             q_1_a1_v = self.Q1(s, a1)
             q_2_a1_v = self.Q2(s, a1)
@@ -229,99 +339,165 @@ class SAC:
             # gradient ascent thus negative sign 
             pi_loss = -tf.reduce_sum(compare_q_a1_v - self.alpha * lpi1)
         
-        pi_grad = tape.gradient(pi_loss, self.pi.trainable_variables)
-        self.pi_optim.apply_gradients(zip(pi_grad, self.pi.trainable_variables))
-
-        del tape
+        pi_grad = tape.gradient(pi_loss, self._pi_vars)
+        self.pi_optim.apply_gradients(zip(pi_grad, self._pi_vars))
 
-        for weight_target, weight in zip(self.Q1_target.trainable_variables, self.Q1.trainable_variables):
-            new_phi = self.polyak * weight_target + (1 - self.polyak) * weight
-            
-            weight_target.assign(new_phi)
-
-        for weight_target, weight in zip(self.Q2_target.trainable_variables, self.Q2.trainable_variables):
-            new_phi = self.polyak * weight_target + (1 - self.polyak) * weight
-            
-            weight_target.assign(new_phi)
+        # one grouped op for both targets so xla fuses all of the per-variable assigns together
+        tf.group([
+            weight_target.assign(self.polyak * weight_target + (1 - self.polyak) * weight)
+            for weight_target, weight in zip(self._target_q_vars, self._q_vars)
+        ])
 
         return q_1_loss, q_2_loss, pi_loss
     
 
+class Learner:
+    # runs the updates on a background thread next to env.step, the env loop is the only writer to the buffer
+    # and the buffer lock keeps its writes from interleaving with the learner's sampling
+    def __init__(self, agent, max_pending_updates=64):
+        self.agent = agent
+        self.buffer_warm = threading.Event()
+        # bounded so the env loop blocks once the learner falls this many updates behind
+        self.pending_updates = queue.Queue(maxsize=max_pending_updates)
+        self.error = None
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        self.buffer_warm.wait()
+        try:
+            # None is the stop signal, it is queued after every pending update so none get dropped
+            while self.pending_updates.get() is not None:
+                self.agent.update()
+        except Exception as e:
+            self.error = e
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("learner thread failed") from self.error
+        if not self.thread.is_alive():
+            raise RuntimeError("learner thread stopped unexpectedly")
+
+    def _put(self, item):
+        # wait for a free slot but keep checking the thread so a dead learner cant hang the env loop
+        while True:
+            self.check()
+            try:
+                self.pending_updates.put(item, timeout=1.0)
+                return
+            except queue.Full:
+                pass
+
+    def request_update(self):
+        self._put(True)
+
+    def close(self):
+        # runs all pending updates before the thread exits
+        self._put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError("learner thread failed") from self.error
+
 def train(env):
-    observation_shape = env.observation_space.shape
-    action_space_dim = env.action_space.shape[0]
+    num_envs = env.num_envs
+    observation_shape = env.single_observation_space.shape
+    action_space_dim = env.single_action_space.shape[0]
 
-    agent = SAC(observation_shape, action_space_dim)
+    agent = SAC(observation_shape, action_space_dim, num_envs=num_envs, observation_dtype=env.single_observation_space.dtype)
+
+    learner = Learner(agent)
 
     init_steps = 10000
     # init_steps = 300
     init_steps_counter = 0
     # to fill the buffer (and for stacking if implemenetd later)
+    # collected on the host and written to the buffer in one go instead of once per step
+    warmup_frames, warmup_actions, warmup_rewards, warmup_terminals, warmup_truncated = [], [], [], [], []
+    # episodes carry on from warmup into training, so their rewards are tracked from the start
+    ep_rewards = np.zeros(shape=num_envs)
+    start_times = [datetime.now()] * num_envs
+    observation, _ = env.reset()
     while (init_steps > init_steps_counter):
-        observation, _ = env.reset()
-        done = False
-        while not done:
-            action = env.action_space.sample()
-            observation2, reward, done, trunc, info = env.step(action)
-            agent.replayMemoryBuffer.store(observation, action, reward, done)
-
-            observation = observation2
-
-            init_steps_counter += 1
-            if (init_steps_counter % 100 == 0):
-                print(f"{init_steps_counter} / {init_steps} filled.")
-
-            if (init_steps <= init_steps_counter):
-                print(f"Buffer filled: {init_steps_counter} time steps. Start Training")   
-                break
+        action = env.action_space.sample()
+        observation2, reward, terminated, truncated, info = env.step(action)
+        warmup_frames.append(observation)
+        warmup_actions.append(action)
+        warmup_rewards.append(reward)
+        warmup_terminals.append(terminated)
+        warmup_truncated.append(truncated)
+
+        observation = observation2
+        ep_rewards += reward
+        for i in np.flatnonzero(terminated | truncated):
+            ep_rewards[i] = 0
+            start_times[i] = datetime.now()
+
+        init_steps_counter += num_envs
+        if (init_steps_counter % 100 < num_envs):
+            print(f"{init_steps_counter} / {init_steps} filled.")
+
+    agent.replayMemoryBuffer.store(
+        np.concatenate(warmup_frames), np.concatenate(warmup_actions),
+        np.concatenate(warmup_rewards), np.concatenate(warmup_terminals), np.concatenate(warmup_truncated)
+    )
+    print(f"Buffer filled: {init_steps_counter} time steps. Start Training")
+    learner.buffer_warm.set()
 
     num_episodes = 1000
     # num_episodes = 3
+    # counted in single env transitions, so one update per transition no matter how many envs
     update_period_timestep = 1
     total_time_steps = 0
 
-    max_num_steps_per_episode = 4000
-    current_episode_time_steps = 0
-
     rewards = np.zeros(shape=num_episodes)
 
-    for episode in range(num_episodes):
-        start_time = datetime.now()
-        observation, _ = env.reset()
-        ep_reward = 0
-        done = False
+    # no reset here, the envs are mid rollout and the last warmup rows need their real next state
+    episode = 0
 
-        while not done:
-            action, _ = agent.pi.sample_action(observation[None, ...])
+    while episode < num_episodes:
+        action = agent.select_action(tf.convert_to_tensor(observation, dtype=tf.float32)).numpy()
 
-            observation2, reward, done, _, _ = env.step(action.numpy()[0])
+        observation2, reward, terminated, truncated, _ = env.step(action)
+        # envs auto reset in the same step, truncated only ends the episode it is not terminal for the Q target
+        done = terminated | truncated
 
-            #s_t, a_t, r_t+1
-            agent.replayMemoryBuffer.store(observation, action, reward, done)
+        #s_t, a_t, r_t+1
+        agent.replayMemoryBuffer.store(observation, action, reward, terminated, truncated)
 
-            # s_t -> s_t+1
-            observation = observation2
-            ep_reward += reward
-            total_time_steps += 1
-	        
-            current_episode_time_steps += 1
+        # s_t -> s_t+1
+        observation = observation2
+        ep_rewards += reward
+        num_updates = (total_time_steps + num_envs) // update_period_timestep - total_time_steps // update_period_timestep
+        total_time_steps += num_envs
 
-            if (total_time_steps % update_period_timestep == 0):
-                agent.update()
-           
-            if (current_episode_time_steps >= max_num_steps_per_episode):
-                break
-        
-        current_episode_time_steps = 0
-        rewards[episode] = ep_reward
-        print(f"Episode {episode}, Reward {ep_reward}, Time Taken: {datetime.now() - start_time}, Total Timesteps: {total_time_steps}")
+        for _ in range(num_updates):
+            learner.request_update()
+        learner.check()
+
+        for i in np.flatnonzero(done):
+            if episode < num_episodes:
+                rewards[episode] = ep_rewards[i]
+                print(f"Episode {episode}, Reward {ep_rewards[i]}, Time Taken: {datetime.now() - start_times[i]}, Total Timesteps: {total_time_steps}")
+                episode += 1
+
+            ep_rewards[i] = 0
+            start_times[i] = datetime.now()
+
+    learner.close()
 
     env.close()
     return rewards
 
-def main():
-    env = gym.make('HalfCheetah-v5', render_mode='rgb_array')
+def make_env():
+    # baseline ran until its own 4000 step cap since it ignored truncation, keep the same episode length
+    env = gym.make('HalfCheetah-v5', max_episode_steps=4000, render_mode='rgb_array')
+    # RecordVideo wraps a single env, so it goes here and not around the vector env
     # env = RecordVideo(env, episode_trigger= lambda x : True, video_folder='saves')
+    return env
+
+def main():
+    env = gym.vector.AsyncVectorEnv([make_env] * NUM_ENVS, autoreset_mode=gym.vector.AutoresetMode.SAME_STEP)
     rewards = train(env)
 
     plt.plot(rewards)